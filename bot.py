@@ -1,17 +1,39 @@
 import os
 import asyncio
-import json
+import math
 import time
 import secrets
 import hashlib
+import hmac
+import atexit
 import base64
 import zlib
-from urllib.parse import urlencode, quote
+import functools
+from urllib.parse import quote
 import re
+import heapq
+import logging
+from collections import OrderedDict
+import orjson
 from aiohttp import web, client
 from aiogram import Bot, Dispatcher, types
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import CommandStart, Command
 
+# uvloop под Windows нет - там остаёмся на стандартном цикле asyncio
+try:
+  import uvloop
+except ImportError:
+  uvloop = None
+
+
+# Уровень меняется через LOG_LEVEL (DEBUG покажет каждый запрос в Steam).
+# Настраиваем при импорте: users/items загружаются раньше main()
+logging.basicConfig(
+  level=os.getenv("LOG_LEVEL", "INFO").upper(),
+  format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
 
 bot_token = os.getenv("bot_token")
 bot_username = os.getenv("bot_username", "")
@@ -32,7 +54,18 @@ data_dir = "/data" if os.path.isdir("/data") else os.path.dirname(os.path.abspat
 users_path = os.path.join(data_dir, "users.json")
 items_path = os.path.join(data_dir, "items.json")
 
-lock = asyncio.Lock()
+# struct_lock - вставка/удаление в users/items (и их индексах),
+# user_lock(token) - изменения внутри одного пользователя и его предметов.
+# Порядок захвата: сначала user_lock, потом struct_lock
+struct_lock = asyncio.Lock()
+user_locks = {}
+
+
+def user_lock(token):
+  lk = user_locks.get(token)
+  if lk is None:
+    lk = user_locks[token] = asyncio.Lock()
+  return lk
 
 
 def decode_backup(encoded_str):
@@ -42,20 +75,20 @@ def decode_backup(encoded_str):
   try:
     compressed = base64.b64decode(encoded_str)
     json_bytes = zlib.decompress(compressed)
-    return json.loads(json_bytes.decode("utf-8"))
+    return orjson.loads(json_bytes)
   except Exception as e:
-    print(f"[decode_backup] failed: {e}")
+    logger.warning("decode_backup failed: %s", e)
     return None
 
 
 def encode_backup(data):
   """Кодирует данные в base64+zlib для ENV"""
   try:
-    json_bytes = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    json_bytes = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
     compressed = zlib.compress(json_bytes, level=9)
     return base64.b64encode(compressed).decode("ascii")
   except Exception as e:
-    print(f"[encode_backup] failed: {e}")
+    logger.warning("encode_backup failed: %s", e)
     return ""
 
 
@@ -63,69 +96,75 @@ def load_json(path, default, env_backup=""):
   # Сначала пробуем загрузить из файла
   if os.path.exists(path):
     try:
-      with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+      with open(path, "rb") as f:
+        data = orjson.loads(f.read())
         if data:  # Если есть данные в файле
-          print(f"[load_json] loaded from file: {path}, items={len(data)}")
+          logger.info("loaded %s: %d records", path, len(data))
           return data
     except Exception as e:
-      print(f"[load_json] file read error: {e}")
+      logger.error("cannot read %s: %s", path, e)
+      # Битый файл не затираем пустым default - откладываем в сторону
+      corrupt_path = f"{path}.corrupt-{int(time.time())}"
+      os.replace(path, corrupt_path)
+      logger.warning("moved unreadable file to %s", corrupt_path)
   
   # Если файл пустой/нет, пробуем из ENV backup
   if env_backup:
     backup_data = decode_backup(env_backup)
     if backup_data:
-      print(f"[load_json] restored from ENV backup, items={len(backup_data)}")
+      logger.info("restored %s from ENV backup: %d records", path, len(backup_data))
       save_json(path, backup_data)  # Сохраняем в файл
       return backup_data
   
   # Создаём пустой файл
-  print(f"[load_json] creating new: {path}")
+  logger.info("creating new %s", path)
   save_json(path, default)
   return default
 
 
+def fsync_dir(dir_path):
+  # Без fsync каталога сам rename может не пережить падение питания
+  if os.name != "posix":
+    return
+  fd = os.open(dir_path or ".", os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+# Хэш последнего записанного содержимого по пути: одинаковый снимок
+# повторно на диск не пишем
+saved_payload_hash = {}
+
+
 def save_json(path, data):
   tmp_path = path + ".tmp"
 
   try:
-    payload = json.dumps(data, ensure_ascii=False, indent=2)
+    # Компактный JSON: файлы читает только бот, отступы лишь раздувают запись
+    payload = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    payload_hash = hashlib.blake2b(payload, digest_size=16).digest()
 
-    print(f"[save_json] path={path}")
-    print(f"[save_json] data_len={len(data) if isinstance(data, list) else 'not list'}")
-    print(f"[save_json] payload_bytes={len(payload)}")
+    if saved_payload_hash.get(path) == payload_hash and os.path.exists(path):
+      return
 
     # Проверяем директорию
     dir_path = os.path.dirname(path)
     if dir_path and not os.path.exists(dir_path):
       os.makedirs(dir_path, exist_ok=True)
-      print(f"[save_json] created directory: {dir_path}")
 
-    with open(tmp_path, "w", encoding="utf-8") as f:
+    with open(tmp_path, "wb") as f:
       f.write(payload)
       f.flush()
       os.fsync(f.fileno())
 
-    print(f"[save_json] tmp file written: {tmp_path}")
-
     os.replace(tmp_path, path)
+    fsync_dir(dir_path)
+    saved_payload_hash[path] = payload_hash
 
-    # Верифицируем запись
-    if os.path.exists(path):
-      size = os.path.getsize(path)
-      print(f"[save_json] OK, final size={size}")
-      
-      # Дополнительная проверка: читаем обратно
-      with open(path, "r", encoding="utf-8") as f:
-        verify = json.load(f)
-      print(f"[save_json] verified, items={len(verify) if isinstance(verify, list) else 'not list'}")
-    else:
-      print(f"[save_json] WARNING: file not found after replace!")
-
-  except Exception as e:
-    print(f"[save_json] FAIL: {repr(e)}")
-    import traceback
-    traceback.print_exc()
+  except Exception:
+    logger.exception("save_json failed: %s", path)
     raise
 
 
@@ -134,220 +173,559 @@ def save_json(path, data):
 users = load_json(users_path, [], USERS_BACKUP_ENV)
 items = load_json(items_path, [], ITEMS_BACKUP_ENV)
 
-print(f"[startup] users loaded: {len(users)}")
-print(f"[startup] items loaded: {len(items)}")
+logger.info("startup: %d users, %d items", len(users), len(items))
+
+
+# Индексы поверх users/items: все поиски за O(1) вместо перебора списков.
+# Значения - те же dict-объекты, что лежат в users/items
+users_by_token = {}
+users_by_chat = {}
+users_by_login_ci = {}
+users_by_pair = {}
+items_by_id = {}
+items_by_user = {}
+
+
+def index_user(user):
+  if user.get("token"):
+    users_by_token[user["token"]] = user
+  if user.get("tg_chat_id"):
+    users_by_chat[user["tg_chat_id"]] = user
+  if user.get("pair_code"):
+    users_by_pair[user["pair_code"]] = user
+  users_by_login_ci[user["tg_login"].lower()] = user
+
+
+def index_item(it):
+  items_by_id[it["id"]] = it
+  items_by_user.setdefault(it["user_token"], []).append(it)
+  schedule_item(it, it.get("last_checked_at", 0) + item_interval_sec(it))
+
+
+def unindex_item(it):
+  items_by_id.pop(it["id"], None)
+  item_due.pop(it["id"], None)
+  user_items = items_by_user.get(it["user_token"])
+  if user_items and it in user_items:
+    user_items.remove(it)
+    if not user_items:
+      del items_by_user[it["user_token"]]
+
+
+# Расписание опроса: min-heap из (due_at, item_id). Актуальный срок
+# предмета лежит в item_due, записи кучи с другим сроком - устаревшие
+# и при извлечении пропускаются
+due_heap = []
+item_due = {}
+poll_wakeup = asyncio.Event()
+
+
+def user_interval_sec(user):
+  interval_min = (user.get("settings") or {}).get("interval_min", 10)
+  try:
+    interval_min = int(interval_min)
+  except Exception:
+    interval_min = 10
+
+  if interval_min < 1:
+    interval_min = 1
+
+  return interval_min * 60
+
+
+def item_interval_sec(it):
+  user = users_by_token.get(it["user_token"])
+  return user_interval_sec(user) if user else 600
+
+
+def schedule_item(it, due_at):
+  item_due[it["id"]] = due_at
+  heapq.heappush(due_heap, (due_at, it["id"]))
+  if due_heap[0][1] == it["id"]:
+    poll_wakeup.set()
+
+
+def schedule_user_items(user):
+  interval = user_interval_sec(user)
+  for it in items_by_user.get(user["token"], []):
+    schedule_item(it, it.get("last_checked_at", 0) + interval)
+
+
+def rebuild_indexes():
+  due_heap.clear()
+  item_due.clear()
+  users_by_token.clear()
+  users_by_chat.clear()
+  users_by_login_ci.clear()
+  users_by_pair.clear()
+  items_by_id.clear()
+  items_by_user.clear()
+
+  for u in users:
+    index_user(u)
+  for it in items:
+    index_item(it)
+
+
+rebuild_indexes()
+
+
+# Изменения не пишутся на диск сразу: обработчики помечают коллекцию
+# "грязной" и будят flusher(), который через flush_interval сек (чтобы
+# собрать пачку изменений) сохраняет её в потоке. Без изменений он спит
+users_dirty = False
+items_dirty = False
+flush_needed = asyncio.Event()
+flush_interval = 1.0
+flush_lock = asyncio.Lock()
+# items.json меняется почти каждый цикл опроса (last_checked_at) - пишем
+# его не чаще раза в items_flush_gap сек, остальное доберёт следующий проход
+items_flush_gap = 5.0
+items_saved_at = 0.0
+
+
+def mark_users_dirty():
+  global users_dirty
+  users_dirty = True
+  flush_needed.set()
+
+
+def mark_items_dirty():
+  global items_dirty
+  items_dirty = True
+  flush_needed.set()
+
+
+# Готовые ответы /api/state (сразу байтами JSON) и тексты /list по токену.
+# Строятся при первом запросе и сбрасываются любым изменением пользователя
+# или его предметов, поэтому api_state читает их без блокировок
+state_snapshot = {}
+list_text_cache = {}
+
+
+def invalidate_user_views(token):
+  state_snapshot.pop(token, None)
+  list_text_cache.pop(token, None)
+
+
+def build_state(user):
+  return orjson.dumps({
+    "ok": True,
+    "tg_username": user.get("tg_username_real") or user.get("tg_login"),
+    "settings": user["settings"],
+    "items": items_by_user.get(user["token"], []),
+    "bot_username": bot_username,
+    "tg_connected": bool(user.get("tg_chat_id"))
+  })
+
 
+def snapshot_users():
+  return [
+    {
+      **u,
+      "settings": dict(u.get("settings") or {})
+    }
+    for u in users
+  ]
+
+
+def snapshot_items():
+  return [dict(it) for it in items]
+
+
+async def flush_dirty(force=False):
+  global users_dirty, items_dirty, items_saved_at
+
+  # Коллекции сохраняются независимо: ошибка в users.json не должна
+  # останавливать запись items.json (и наоборот). Первая ошибка - наружу
+  error = None
+
+  async with flush_lock:
+    if users_dirty:
+      users_dirty = False
+      try:
+        await asyncio.to_thread(save_json, users_path, snapshot_users())
+      except Exception as e:
+        users_dirty = True
+        error = error or e
+
+    if items_dirty and (force or time.monotonic() - items_saved_at >= items_flush_gap):
+      items_dirty = False
+      items_saved_at = time.monotonic()
+      try:
+        await asyncio.to_thread(save_json, items_path, snapshot_items())
+      except Exception as e:
+        items_dirty = True
+        error = error or e
+
+  if error is not None:
+    raise error
+
+
+def flush_dirty_at_exit():
+  # Последний шанс, если процесс завершается в обход on_cleanup.
+  # Ошибки уже залогированы в save_json - просто идём к следующему файлу
+  if users_dirty:
+    try:
+      save_json(users_path, snapshot_users())
+    except Exception:
+      pass
+  if items_dirty:
+    try:
+      save_json(items_path, snapshot_items())
+    except Exception:
+      pass
+
+
+atexit.register(flush_dirty_at_exit)
+
+
+# Алгоритм для новых хэшей. У старых пользователей поля hash_algo нет -
+# это sha256; sha256 и blake2b пересчитываются в scrypt при следующем входе
+password_hash_algo = "scrypt"
+
+
+def hash_password(password, salt, algo=password_hash_algo):
+  if algo == "scrypt":
+    return hashlib.scrypt(
+      password.encode("utf-8"),
+      salt=salt.encode("utf-8"),
+      n=2 ** 14,
+      r=8,
+      p=1,
+      dklen=32
+    ).hex()
 
-def hash_password(password, salt):
   s = (salt + password).encode("utf-8")
-  return hashlib.sha256(s).hexdigest()
+  if algo == "sha256":
+    return hashlib.sha256(s).hexdigest()
+  return hashlib.blake2b(s, digest_size=32).hexdigest()
 
 
 def find_user_by_login(tg_username):
-  for u in users:
-    if u["tg_login"].lower() == tg_username.lower():
-      return u
-  return None
+  return users_by_login_ci.get(tg_username.lower())
 
 
 def find_user_by_token(token):
-  for u in users:
-    if u.get("token") == token:
-      return u
-  return None
+  # token приходит из запроса как есть - list/dict в dict.get() не пролезет
+  if not isinstance(token, str):
+    return None
+  return users_by_token.get(token)
 
 
 def find_user_by_chat(chat_id):
-  for u in users:
-    if u.get("tg_chat_id") == chat_id:
-      return u
-  return None
+  return users_by_chat.get(chat_id)
+
+
+def find_user_by_pair_code(code):
+  user = users_by_pair.get(code)
+  if not user or user.get("tg_chat_id"):
+    return None
+  if user.get("pair_expires_at", 0) < now_sec():
+    return None
+  return user
+
+
+# Код привязки Telegram живёт pair_code_ttl секунд
+pair_code_ttl = 600
+
+
+def expire_pair_codes():
+  now = now_sec()
+  expired = [
+    code for code, u in users_by_pair.items()
+    if u.get("pair_expires_at", 0) < now
+  ]
+  for code in expired:
+    user = users_by_pair.pop(code)
+    if user.get("pair_code") == code:
+      user["pair_code"] = None
+      user.pop("pair_expires_at", None)
+      mark_users_dirty()
 
 
 def now_sec():
   return int(time.time())
 
 
-steam_timeout = client.ClientTimeout(total=10)
+steam_timeout = client.ClientTimeout(total=15, connect=5)
 steam_base_headers = {
   "user-agent": "steam-track-n-buy/1.0",
   "accept": "application/json,text/plain,*/*",
-  "accept-language": "en-US,en;q=0.9"
+  "accept-language": "en-US,en;q=0.9,ru;q=0.8",
+  "referer": "https://steamcommunity.com/market/"
 }
 steam_session = None
+# Сколько запросов к Steam идёт одновременно: и семафор polling_loop,
+# и limit_per_host коннектора берут это значение
+steam_concurrency = 4
+steam_request_timeout = client.ClientTimeout(total=8, connect=5)
+
+# Защита от бана: steam_429_limit ответов 429 подряд за steam_429_window
+# секунд - и опрос Steam встаёт на паузу steam_cooldown секунд
+steam_429_limit = 5
+steam_429_window = 30
+steam_cooldown = 60
+steam_429_streak = 0
+steam_429_first_at = 0
+steam_cooldown_until = 0
+
+
+def note_steam_rate_limited():
+  global steam_429_streak, steam_429_first_at, steam_cooldown_until
+  now = now_sec()
+
+  if steam_429_streak == 0 or now - steam_429_first_at > steam_429_window:
+    steam_429_streak = 0
+    steam_429_first_at = now
+
+  steam_429_streak += 1
+  if steam_429_streak >= steam_429_limit:
+    steam_429_streak = 0
+    steam_cooldown_until = now + steam_cooldown
+    logger.warning("steam rate limit: polling paused for %s sec", steam_cooldown)
+
+
+def note_steam_ok():
+  global steam_429_streak
+  steam_429_streak = 0
+
+
+# (appid, hash_name, currency_code) -> (expires_at, price). Неудача (None)
+# тоже кэшируется, но коротко - чтобы не долбить Steam повторами.
+# Размер ограничен: сверх price_cache_max вытесняются давно не читанные
+price_cache = OrderedDict()
+price_cache_ttl = 60
+price_cache_fail_ttl = 15
+price_cache_max = 5000
+# (appid, hash_name, currency_code) -> Future с результатом идущего запроса
+price_inflight = {}
 
 
 async def get_steam_session():
+  # Одна сессия на весь процесс: keep-alive соединения к steamcommunity.com
+  # переиспользуются между запросами цен
   global steam_session
   if steam_session is None or steam_session.closed:
-    steam_session = client.ClientSession(timeout=steam_timeout, headers=steam_base_headers)
+    connector = client.TCPConnector(
+      limit=20,
+      limit_per_host=steam_concurrency,
+      ttl_dns_cache=300,
+      keepalive_timeout=60
+    )
+    steam_session = client.ClientSession(
+      connector=connector,
+      timeout=steam_timeout,
+      headers=steam_base_headers
+    )
   return steam_session
 
 
-def parse_price_str(price_str):
-  s = (
-    str(price_str)
-      .replace(" ", "")
-      .replace("\xa0", "")
-  )
-  s = "".join(ch for ch in s if ch.isdigit() or ch in ".,")
-  if not s:
-    return None
+async def close_steam_session(app):
+  if steam_session is not None and not steam_session.closed:
+    await steam_session.close()
 
-  last_dot = s.rfind(".")
-  last_comma = s.rfind(",")
 
-  if last_dot != -1 and last_comma != -1:
-    if last_comma > last_dot:
-      dec = ","
-      thou = "."
-    else:
-      dec = "."
-      thou = ","
-    s = s.replace(thou, "")
-    s = s.replace(dec, ".")
-  else:
-    sep = "." if last_dot != -1 else ("," if last_comma != -1 else None)
-    if sep:
-      parts = s.split(sep)
-      if len(parts) > 2:
-        decimal = parts[-1]
-        int_part = "".join(parts[:-1])
-        s = int_part + "." + decimal
-      else:
-        s = s.replace(sep, ".")
+# Разделители тысяч у Steam бывают любыми пробелами (обычный, NBSP,
+# узкий NBSP U+202F...) - удаляем всё, что считается пробелом
+price_space_table = dict.fromkeys(
+  i for i in range(0x3001) if chr(i).isspace()
+)
+# число с разделителями внутри: "1 234,56", "1,234.56", "5"
+price_number_re = re.compile(r"\d(?:[\d\s\.,]*\d)?")
 
-  try:
-    return float(s)
-  except Exception:
-    return None
 
 def parse_price(price_text):
   if price_text is None:
     return None
 
-  text = str(price_text)
-  text = text.replace("\xa0", " ")
-  text = text.strip()
-
-  if text == "":
-    return None
-
-  m = re.search(r"\d[\d\s\.,]*\d", text)
+  m = price_number_re.search(str(price_text))
   if not m:
     return None
 
-  cleaned = m.group(0)
-  cleaned = cleaned.replace(" ", "")
-
-  has_comma = "," in cleaned
-  has_dot = "." in cleaned
+  cleaned = m.group(0).translate(price_space_table)
 
-  if has_comma and has_dot:
-    last_comma = cleaned.rfind(",")
-    last_dot = cleaned.rfind(".")
+  last_comma = cleaned.rfind(",")
+  last_dot = cleaned.rfind(".")
 
+  if last_comma != -1 and last_dot != -1:
+    # Десятичный - тот, что правее: "1.234,56" / "1,234.56"
     if last_comma > last_dot:
-      cleaned = cleaned.replace(".", "")
-      cleaned = cleaned.replace(",", ".")
+      cleaned = cleaned.replace(".", "").replace(",", ".")
     else:
       cleaned = cleaned.replace(",", "")
 
-  elif has_comma and not has_dot:
-    cleaned = cleaned.replace(",", ".")
+  elif last_comma != -1 or last_dot != -1:
+    sep = "," if last_comma != -1 else "."
+    # Повторяющийся разделитель ("1.234.567") - это тысячи
+    if cleaned.count(sep) > 1:
+      cleaned = cleaned.replace(sep, "")
+    else:
+      cleaned = cleaned.replace(sep, ".")
 
   try:
     return float(cleaned)
-  except Exception:
+  except ValueError:
     return None
 
 
-async def fetch_price(appid, hash_name, currency_code):
-  params = {
-    "appid": str(appid),
-    "market_hash_name": hash_name,
-    "currency": str(currency_code),
-    "format": "json"
-  }
-
-  url = "https://steamcommunity.com/market/priceoverview/?" + urlencode(
-    params,
-    quote_via=quote,
-    safe=""
+# appid и валюта почти всегда одни и те же - префикс URL собираем один раз
+@functools.lru_cache(maxsize=64)
+def price_url_prefix(appid, currency_code):
+  return (
+    "https://steamcommunity.com/market/priceoverview/"
+    f"?appid={appid}&currency={currency_code}&format=json&market_hash_name="
   )
-  print("price fetch url:", url)
 
-  headers = {
-    "user-agent": "steam-track-n-buy/1.0",
-    "accept": "application/json,text/plain,*/*",
-    "accept-language": "en-US,en;q=0.9,ru;q=0.8",
-    "referer": "https://steamcommunity.com/market/"
-  }
 
-  timeout = client.ClientTimeout(total=12)
+async def request_price(appid, hash_name, currency_code):
+  url = price_url_prefix(int(appid), int(currency_code)) + quote(hash_name, safe="")
+  logger.debug("price fetch url: %s", url)
 
-  async with client.ClientSession(timeout=timeout) as session:
-    for attempt in range(3):
-      try:
-        async with session.get(url, headers=headers) as r:
-          body_text = await r.text()
+  session = await get_steam_session()
 
-          if r.status == 429:
-            if attempt < 2:
-              wait_sec = 1 + attempt
-              print("price fetch rate limited:", r.status, "wait:", wait_sec)
-              await asyncio.sleep(wait_sec)
-              continue
+  for attempt in range(3):
+    try:
+      async with session.get(url, timeout=steam_request_timeout) as r:
+        status = r.status
+        # Тело читаем только у 200: при 429/5xx Steam отдаёт HTML-заглушку
+        if status == 200:
+          body = await r.read()
 
-          if r.status != 200:
-            print("price fetch bad status:", r.status)
-            print("price fetch body:", body_text[:300])
-            return None
+    except Exception as e:
+      if attempt < 2:
+        wait_sec = 1 + attempt
+        logger.debug("price fetch error, retry in %s sec: %r", wait_sec, e)
+        await asyncio.sleep(wait_sec)
+        continue
 
-      except Exception as e:
-        if attempt < 2:
-          wait_sec = 1 + attempt
-          print("price fetch error retry:", e, "wait:", wait_sec)
-          await asyncio.sleep(wait_sec)
-          continue
+      logger.warning("price fetch error: %r", e)
+      return None
+
+    # Ответ уже отпущен: пауза перед повтором не держит соединение,
+    # и остальные запросы к Steam идут через освободившийся слот
+    if status == 429:
+      note_steam_rate_limited()
+      if attempt < 2 and steam_cooldown_until <= now_sec():
+        wait_sec = 2 ** attempt
+        logger.debug("price fetch rate limited, wait %s sec", wait_sec)
+        await asyncio.sleep(wait_sec)
+        continue
 
-        print("price fetch error:", e)
-        return None
+    if status != 200:
+      logger.warning("price fetch bad status %s: %s", status, hash_name)
+      return None
 
-      try:
-        data = json.loads(body_text)
-      except Exception as e:
-        print("price fetch json parse error:", e)
-        print("price fetch body:", body_text[:300])
-        return None
+    note_steam_ok()
+
+    try:
+      data = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+      logger.warning("price fetch json parse error: %s, body: %r", e, body[:300])
+      return None
 
-      print("price fetch raw data:", data)
+    logger.debug("price fetch raw data: %s", data)
 
-      if not isinstance(data, dict):
-        print("price fetch unexpected type:", type(data))
-        return None
+    if not isinstance(data, dict):
+      logger.warning("price fetch unexpected type: %s", type(data))
+      return None
 
-      if not data.get("success"):
-        print("price fetch not success:", data)
-        return None
+    if not data.get("success"):
+      logger.info("price fetch not success: %s %s", hash_name, data)
+      return None
 
-      price_text = data.get("lowest_price") or data.get("median_price")
-      print("price fetch price_text:", price_text)
+    price_text = data.get("lowest_price") or data.get("median_price")
 
-      price_value = parse_price(price_text)
-      if price_value is None:
-        print("price parse failed:", price_text)
-        return None
+    price_value = parse_price(price_text)
+    if price_value is None:
+      logger.warning("price parse failed: %r", price_text)
+      return None
 
-      return price_value
+    return price_value
 
   return None
 
 
+async def fetch_price(appid, hash_name, currency_code):
+  # Один и тот же предмет у разных пользователей - один запрос в Steam:
+  # свежая цена берётся из кэша, а параллельные запросы ждут уже идущий
+  key = (int(appid), hash_name, int(currency_code))
+
+  cached = price_cache.get(key)
+  if cached and cached[0] > time.monotonic():
+    price_cache.move_to_end(key)
+    return cached[1]
+
+  fut = price_inflight.get(key)
+  if fut is not None:
+    return await asyncio.shield(fut)
+
+  fut = asyncio.get_running_loop().create_future()
+  price_inflight[key] = fut
+
+  price = None
+  try:
+    price = await request_price(appid, hash_name, currency_code)
+    ttl = price_cache_ttl if price is not None else price_cache_fail_ttl
+    price_cache[key] = (time.monotonic() + ttl, price)
+    price_cache.move_to_end(key)
+    if len(price_cache) > price_cache_max:
+      price_cache.popitem(last=False)
+    return price
+  finally:
+    price_inflight.pop(key, None)
+    if not fut.done():
+      fut.set_result(price)
+
+
+def evict_price_cache():
+  now = time.monotonic()
+  expired = [key for key, (expires_at, _) in price_cache.items() if expires_at <= now]
+  for key in expired:
+    del price_cache[key]
+
+
 def make_item_id(appid, hash_name, user_token):
   return f"{user_token}|{appid}|{hash_name}"
 
 
+# Исходящие сообщения в Telegram идут через очереди: обработчики и
+# polling_loop не ждут ответа Telegram. У каждого из tg_workers воркеров
+# своя очередь, чат всегда попадает в одну и ту же (hash(chat_id)), так что
+# сообщения одного чата уходят по порядку и не параллельно, а разные чаты -
+# одновременно. Очереди ограничены - при переполнении (Telegram лежит)
+# новые сообщения отбрасываются, а не копятся в памяти
+tg_workers = 4
+tg_queues = [asyncio.Queue(maxsize=250) for _ in range(tg_workers)]
+tg_send_attempts = 3
+
+
+def queue_message(chat_id, text):
+  try:
+    tg_queues[hash(chat_id) % tg_workers].put_nowait((chat_id, text))
+  except asyncio.QueueFull:
+    logger.warning("tg queue full, message dropped: %s", chat_id)
+
+
+async def tg_worker(queue):
+  while True:
+    chat_id, text = await queue.get()
+    try:
+      # Повторы здесь же, а не в конец очереди - иначе следующее сообщение
+      # этого чата обгонит неотправленное
+      for attempt in range(tg_send_attempts):
+        try:
+          await tg_bot.send_message(chat_id, text)
+          break
+        except Exception as e:
+          logger.warning("tg send error (attempt %d): %s", attempt + 1, e)
+          if attempt + 1 < tg_send_attempts:
+            wait_sec = e.retry_after if isinstance(e, TelegramRetryAfter) else 1
+            await asyncio.sleep(wait_sec)
+    finally:
+      queue.task_done()
+
+
 @web.middleware
 async def cors_middleware(request, handler):
   if request.method == "OPTIONS":
@@ -374,14 +752,14 @@ async def start_handler(message: types.Message):
     )
     return
 
-  async with lock:
-    user = None
-    for u in users:
-      if u.get("pair_code") == code and not u.get("tg_chat_id"):
-        user = u
-        break
+  user = find_user_by_pair_code(code)
 
-    if not user:
+  if not user:
+    await message.answer("Code is invalid or already used.")
+    return
+
+  async with user_lock(user["token"]):
+    if user.get("tg_chat_id") or user.get("pair_code") != code:
       await message.answer("Code is invalid or already used.")
       return
 
@@ -391,8 +769,13 @@ async def start_handler(message: types.Message):
       if message.from_user.username else user["tg_login"]
     )
     user["pair_code"] = None
+    user.pop("pair_expires_at", None)
+    users_by_chat[user["tg_chat_id"]] = user
+    users_by_pair.pop(code, None)
+    schedule_user_items(user)
+    invalidate_user_views(user["token"])
 
-    save_json(users_path, users)
+    mark_users_dirty()
 
   await message.answer(
     "✅ Steam Track n Buy is now connected.\n"
@@ -407,48 +790,71 @@ async def start_handler(message: types.Message):
 async def list_items_handler(message: types.Message):
   chat_id = message.chat.id
 
-  async with lock:
-    user = find_user_by_chat(chat_id)
+  user = find_user_by_chat(chat_id)
 
-    if not user:
-      await message.answer(
-        "First link Telegram via the browser extension (Connect Telegram)."
-      )
-      return
+  if not user:
+    await message.answer(
+      "First link Telegram via the browser extension (Connect Telegram)."
+    )
+    return
 
-    user_token = user["token"]
-    my_items = [it for it in items if it["user_token"] == user_token]
-    cur = user["settings"]["currency_label"]
+  user_token = user["token"]
+  text = list_text_cache.get(user_token)
 
-  if len(my_items) == 0:
-    await message.answer("You don't have any tracked items yet.")
-    return
+  if text is None:
+    async with user_lock(user_token):
+      text = build_list_text(user)
+      list_text_cache[user_token] = text
 
-  lines = []
-  for i, it in enumerate(my_items, start=1):
-    last_price = it.get("last_price")
-    last_price_str = "?" if last_price is None else f"{last_price} {cur}"
+  await message.answer(text)
+
+
+list_mode_buy = "waiting for price drop (buy)"
+list_mode_sell = "waiting for price rise (sell)"
+list_line_fmt = "%d. %s\n   now: %s\n   target: %s %s\n   mode: %s"
 
-    direction = it.get("direction")
-    dir_str = (
-      "waiting for price drop (buy)"
-      if direction == "buy"
-      else "waiting for price rise (sell)"
-    )
 
-    lines.append(
-      f"{i}. {it['hash_name']}\n"
-      f"   now: {last_price_str}\n"
-      f"   target: {it['target_price']} {cur}\n"
-      f"   mode: {dir_str}"
+def build_list_text(user):
+  my_items = items_by_user.get(user["token"], [])
+  cur = user["settings"]["currency_label"]
+
+  if len(my_items) == 0:
+    return "You don't have any tracked items yet."
+
+  lines = [
+    list_line_fmt % (
+      i,
+      it["hash_name"],
+      "?" if it.get("last_price") is None else f"{it['last_price']} {cur}",
+      it["target_price"],
+      cur,
+      list_mode_buy if it.get("direction") == "buy" else list_mode_sell
     )
+    for i, it in enumerate(my_items, start=1)
+  ]
 
-  text = "📌 Your tracked items:\n\n" + "\n\n".join(lines)
-  await message.answer(text)
+  return "📌 Your tracked items:\n\n" + "\n\n".join(lines)
 
 
 # ---------- HTTP API ----------
 
+def json_response(data, status=200):
+  return web.Response(
+    body=orjson.dumps(data),
+    status=status,
+    content_type="application/json"
+  )
+
+
+async def read_json(request):
+  # Битое или не-объектное тело - пустой dict: обработчик ответит bad_input/no_auth
+  try:
+    data = orjson.loads(await request.read())
+  except orjson.JSONDecodeError:
+    return {}
+  return data if isinstance(data, dict) else {}
+
+
 async def healthz(request):
   return web.Response(text="ok")
 
@@ -462,16 +868,24 @@ async def api_backup(request):
   expected = os.getenv("BACKUP_SECRET", "")
   
   if not expected or secret != expected:
-    return web.json_response({"ok": False, "error": "unauthorized"}, status=401)
+    return json_response({"ok": False, "error": "unauthorized"}, status=401)
   
-  async with lock:
-    users_backup = encode_backup(users)
-    items_backup = encode_backup(items)
+  # Под блокировкой только копируем, сжатие - в потоке
+  async with struct_lock:
+    users_snap = snapshot_users()
+    items_snap = snapshot_items()
+
+  users_backup = await asyncio.to_thread(encode_backup, users_snap)
+  items_backup = await asyncio.to_thread(encode_backup, items_snap)
+
+  # Пустая строка - ошибка кодирования, а не пустые данные: "[]" тоже кодируется
+  if not users_backup or not items_backup:
+    return json_response({ "ok": False, "error": "encode_failed" }, status=500)
   
-  return web.json_response({
+  return json_response({
     "ok": True,
-    "users_count": len(users),
-    "items_count": len(items),
+    "users_count": len(users_snap),
+    "items_count": len(items_snap),
     "USERS_BACKUP": users_backup,
     "ITEMS_BACKUP": items_backup,
     "instruction": "Add these values to Render Environment Variables to persist data across restarts"
@@ -480,27 +894,32 @@ async def api_backup(request):
 
 # registration: tg_username + password
 async def api_register(request):
-  data = await request.json()
+  data = await read_json(request)
 
   tg_username = (data.get("tg_username") or "").strip()
   password = (data.get("password") or "").strip()
 
   if len(tg_username) < 2 or len(password) < 4 or not tg_username.startswith("@"):
-    return web.json_response({ "ok": False, "error": "bad_input" })
+    return json_response({ "ok": False, "error": "bad_input" })
 
-  async with lock:
-    if find_user_by_login(tg_username):
-      return web.json_response({ "ok": False, "error": "exists" })
+  if find_user_by_login(tg_username):
+    return json_response({ "ok": False, "error": "exists" })
 
-    salt = secrets.token_hex(8)
-    pw_hash = hash_password(password, salt)
-    token = secrets.token_hex(16)
+  # Хэширование - в потоке, чтобы не держать event loop и struct_lock
+  salt = secrets.token_hex(8)
+  pw_hash = await asyncio.to_thread(hash_password, password, salt)
+  token = secrets.token_hex(16)
+
+  async with struct_lock:
+    if find_user_by_login(tg_username):
+      return json_response({ "ok": False, "error": "exists" })
 
-    users.append({
+    user = {
       "tg_login": tg_username,
       "tg_username_real": None,
       "salt": salt,
       "pw_hash": pw_hash,
+      "hash_algo": password_hash_algo,
       "token": token,
       "tg_chat_id": None,
       "pair_code": None,
@@ -510,43 +929,55 @@ async def api_register(request):
         "language": "en",
         "interval_min": 10
       }
-    })
+    }
+    users.append(user)
+    index_user(user)
 
-    print("api_register before save")
-    print("users_path:", users_path)
-    print("users_len:", len(users))
+    logger.info("registered %s, users: %d", tg_username, len(users))
 
-    save_json(users_path, users)
+    mark_users_dirty()
 
-    print("api_register after save")
-    print("users_len:", len(users))
-
-  return web.json_response({ "ok": True })
+  return json_response({ "ok": True })
 
 
 
 # login: tg_username + password
 async def api_login(request):
-  data = await request.json()
+  data = await read_json(request)
 
   tg_username = (data.get("tg_username") or "").strip()
   password = (data.get("password") or "").strip()
 
-  async with lock:
-    user = find_user_by_login(tg_username)
-
-    if not user:
-      return web.json_response({ "ok": False, "error": "not_found" })
-
-    pw_hash = hash_password(password, user["salt"])
-    if pw_hash != user["pw_hash"]:
-      return web.json_response({ "ok": False, "error": "wrong_pass" })
-
-    if not user.get("token"):
-      user["token"] = secrets.token_hex(16)
-      save_json(users_path, users)
-
-  return web.json_response({
+  user = find_user_by_login(tg_username)
+
+  if not user:
+    return json_response({ "ok": False, "error": "not_found" })
+
+  # Алгоритм и хэш читаем вместе до await: параллельный вход может
+  # успеть перевести пароль на новый алгоритм, пока считается хэш
+  algo = user.get("hash_algo", "sha256")
+  stored_hash = user["pw_hash"]
+  pw_hash = await asyncio.to_thread(hash_password, password, user["salt"], algo)
+  if not hmac.compare_digest(pw_hash, stored_hash):
+    return json_response({ "ok": False, "error": "wrong_pass" })
+
+  if not user.get("token"):
+    async with struct_lock:
+      if not user.get("token"):
+        user["token"] = secrets.token_hex(16)
+        users_by_token[user["token"]] = user
+        mark_users_dirty()
+
+  if algo != password_hash_algo:
+    new_hash = await asyncio.to_thread(hash_password, password, user["salt"])
+    async with user_lock(user["token"]):
+      # Хэш мог уже смениться (миграция другим входом) - тогда не трогаем
+      if user.get("hash_algo", "sha256") == algo and user["pw_hash"] == stored_hash:
+        user["pw_hash"] = new_hash
+        user["hash_algo"] = password_hash_algo
+        mark_users_dirty()
+
+  return json_response({
     "ok": True,
     "token": user["token"]
   })
@@ -555,38 +986,42 @@ async def api_login(request):
 async def api_state(request):
   token = request.query.get("token")
 
-  async with lock:
+  snap = state_snapshot.get(token)
+  if snap is None:
     user = find_user_by_token(token)
     if not user:
-      return web.json_response({ "ok": False, "error": "no_auth" })
+      return json_response({ "ok": False, "error": "no_auth" })
 
-    user_token = user["token"]
-    my_items = [it for it in items if it["user_token"] == user_token]
+    snap = build_state(user)
+    state_snapshot[user["token"]] = snap
 
-    return web.json_response({
-      "ok": True,
-      "tg_username": user.get("tg_username_real") or user.get("tg_login"),
-      "settings": user["settings"],
-      "items": my_items,
-      "bot_username": bot_username,
-      "tg_connected": bool(user.get("tg_chat_id"))
-    })
+  return web.Response(body=snap, content_type="application/json")
 
 
 async def api_pair_start(request):
-  data = await request.json()
+  data = await read_json(request)
   token = data.get("token")
 
-  async with lock:
-    user = find_user_by_token(token)
-    if not user:
-      return web.json_response({ "ok": False, "error": "no_auth" })
+  user = find_user_by_token(token)
+  if not user:
+    return json_response({ "ok": False, "error": "no_auth" })
+
+  async with user_lock(user["token"]):
+    expire_pair_codes()
 
-    code = str(secrets.randbelow(900000) + 100000)
+    while True:
+      code = str(secrets.randbelow(900000) + 100000)
+      if code not in users_by_pair:
+        break
+
+    if user.get("pair_code"):
+      users_by_pair.pop(user["pair_code"], None)
     user["pair_code"] = code
-    save_json(users_path, users)
+    user["pair_expires_at"] = now_sec() + pair_code_ttl
+    users_by_pair[code] = user
+    mark_users_dirty()
 
-  return web.json_response({
+  return json_response({
     "ok": True,
     "code": code,
     "bot_username": bot_username
@@ -594,58 +1029,74 @@ async def api_pair_start(request):
 
 
 async def api_settings(request):
-  data = await request.json()
+  data = await read_json(request)
   token = data.get("token")
 
-  async with lock:
-    user = find_user_by_token(token)
-    if not user:
-      return web.json_response({ "ok": False, "error": "no_auth" })
+  user = find_user_by_token(token)
+  if not user:
+    return json_response({ "ok": False, "error": "no_auth" })
 
+  async with user_lock(user["token"]):
     settings = user["settings"]
+    changed = False
 
-    if data.get("currency_label") in ["RUB", "USD"]:
-      settings["currency_label"] = data["currency_label"]
-      settings["currency_code"] = 5 if data["currency_label"] == "RUB" else 1
+    currency_label = data.get("currency_label")
+    if currency_label in ["RUB", "USD"] and settings.get("currency_label") != currency_label:
+      settings["currency_label"] = currency_label
+      settings["currency_code"] = 5 if currency_label == "RUB" else 1
+      changed = True
 
     interval_min = data.get("interval_min")
     try:
       interval = int(interval_min)
-    except (TypeError, ValueError):
+    except (TypeError, ValueError, OverflowError):
       interval = settings.get("interval_min", 10)
 
+    # Не чаще раза в минуту и не реже раза в сутки; заодно orjson не
+    # сериализует int больше 64 бит - такое значение сломало бы users.json
     if interval < 1:
       interval = 1
+    if interval > 1440:
+      interval = 1440
+
+    if settings.get("interval_min") != interval:
+      settings["interval_min"] = interval
+      changed = True
 
-    settings["interval_min"] = interval
-    settings["language"] = "en"
+    if settings.get("language") != "en":
+      settings["language"] = "en"
+      changed = True
 
-    save_json(users_path, users)
+    # Пустые/повторные запросы настроек не трогают диск и расписание
+    if changed:
+      schedule_user_items(user)
+      invalidate_user_views(user["token"])
+      mark_users_dirty()
 
-  return web.json_response({ "ok": True })
+  return json_response({ "ok": True })
 
 
 async def api_use(request):
-  data = await request.json()
+  data = await read_json(request)
   token = data.get("token")
   action = (data.get("action") or "use").strip()
 
-  async with lock:
-    user = find_user_by_token(token)
-    if not user:
-      return web.json_response({ "ok": False })
+  user = find_user_by_token(token)
+  if not user:
+    return json_response({ "ok": False })
 
+  async with user_lock(user["token"]):
     chat_id = user.get("tg_chat_id")
 
   if chat_id:
     text = f"🟦 Steam Track n Buy used: {action}"
-    await tg_bot.send_message(chat_id, text)
+    queue_message(chat_id, text)
 
-  return web.json_response({ "ok": True })
+  return json_response({ "ok": True })
 
 
 async def api_track(request):
-  data = await request.json()
+  data = await read_json(request)
 
   token = data.get("token")
   appid_raw = data.get("appid")
@@ -653,11 +1104,11 @@ async def api_track(request):
   target_raw = data.get("target_price")
   direction_raw = (str(data.get("direction") or "")).strip().lower()
 
-  async with lock:
-    user = find_user_by_token(token)
-    if not user:
-      return web.json_response({ "ok": False, "error": "no_auth" })
+  user = find_user_by_token(token)
+  if not user:
+    return json_response({ "ok": False, "error": "no_auth" })
 
+  async with user_lock(user["token"]):
     settings = user["settings"]
     chat_id = user.get("tg_chat_id")
     user_token = user["token"]
@@ -665,18 +1116,27 @@ async def api_track(request):
   try:
     appid = int(appid_raw)
   except (TypeError, ValueError):
-    return web.json_response({ "ok": False, "error": "bad_appid" })
+    return json_response({ "ok": False, "error": "bad_appid" })
+
+  # orjson не сериализует int больше 64 бит - такой appid сломал бы
+  # сохранение items.json для всех пользователей
+  if not 0 < appid < 2 ** 32:
+    return json_response({ "ok": False, "error": "bad_appid" })
 
   try:
     target_price = float(target_raw)
   except (TypeError, ValueError):
-    return web.json_response({ "ok": False, "error": "bad_price" })
+    return json_response({ "ok": False, "error": "bad_price" })
+
+  # nan/inf orjson сохранит как null - после перезапуска сравнивать не с чем
+  if not math.isfinite(target_price):
+    return json_response({ "ok": False, "error": "bad_price" })
 
   if not hash_name or target_price <= 0:
-    return web.json_response({ "ok": False, "error": "bad_input" })
+    return json_response({ "ok": False, "error": "bad_input" })
 
   if direction_raw not in ("buy", "sell"):
-    return web.json_response({ "ok": False, "error": "bad_direction" })
+    return json_response({ "ok": False, "error": "bad_direction" })
 
   direction = direction_raw
   now = now_sec()
@@ -685,12 +1145,8 @@ async def api_track(request):
 
   item_id = make_item_id(appid, hash_name, user_token)
 
-  async with lock:
-    exist = None
-    for it in items:
-      if it["id"] == item_id:
-        exist = it
-        break
+  async with user_lock(user_token):
+    exist = items_by_id.get(item_id)
 
     if exist:
       exist["target_price"] = target_price
@@ -698,8 +1154,9 @@ async def api_track(request):
       exist["enabled"] = True
       exist["last_price"] = current_price
       exist["last_checked_at"] = now
+      schedule_item(exist, now + user_interval_sec(user))
     else:
-      items.append({
+      it = {
         "id": item_id,
         "user_token": user_token,
         "appid": appid,
@@ -710,9 +1167,13 @@ async def api_track(request):
         "last_price": current_price,
         "last_checked_at": now,
         "last_notified_at": 0
-      })
+      }
+      async with struct_lock:
+        items.append(it)
+        index_item(it)
 
-    save_json(items_path, items)
+    invalidate_user_views(user_token)
+    mark_items_dirty()
 
   if chat_id:
     cur = settings["currency_label"]
@@ -743,12 +1204,9 @@ async def api_track(request):
       f"{advise}"
     )
 
-    try:
-      await tg_bot.send_message(chat_id, text)
-    except Exception as e:
-      print("tg send error:", e)
+    queue_message(chat_id, text)
 
-  return web.json_response({
+  return json_response({
     "ok": True,
     "current_price": current_price,
     "direction": direction
@@ -757,138 +1215,191 @@ async def api_track(request):
 
 
 async def api_untrack(request):
-  data = await request.json()
+  data = await read_json(request)
   token = data.get("token")
   item_id = data.get("item_id")
 
-  async with lock:
-    user = find_user_by_token(token)
-    if not user:
-      return web.json_response({ "ok": False, "error": "no_auth" })
-
-    user_token = user["token"]
+  user = find_user_by_token(token)
+  if not user:
+    return json_response({ "ok": False, "error": "no_auth" })
 
-    new_items = []
-    for it in items:
-      if it["id"] == item_id and it["user_token"] == user_token:
-        continue
-      new_items.append(it)
+  user_token = user["token"]
 
-    items.clear()
-    items.extend(new_items)
+  async with user_lock(user_token), struct_lock:
+    it = items_by_id.get(item_id) if isinstance(item_id, str) else None
 
-    save_json(items_path, items)
+    if it and it["user_token"] == user_token:
+      items.remove(it)
+      unindex_item(it)
+      invalidate_user_views(user_token)
+      mark_items_dirty()
 
-  return web.json_response({ "ok": True })
+  return json_response({ "ok": True })
 
 
 # ---------- price polling ----------
 
 async def polling_loop():
   while True:
-    await asyncio.sleep(3)
-
-    async with lock:
-      local_users = [
-        {
-          **u,
-          "settings": dict(u.get("settings") or {})
-        }
-        for u in users
-      ]
-
-      local_items = [dict(it) for it in items]
-
-    token_to_user = {}
-    for u in local_users:
-      token_to_user[u.get("token")] = u
-
+    # Спим до ближайшего срока (или до конца паузы после 429 от Steam);
+    # schedule_item() будит раньше, если появился предмет с более ранним сроком
+    poll_wakeup.clear()
     now = now_sec()
+    wait_sec = due_heap[0][0] - now if due_heap else 60
+    wait_sec = max(wait_sec, steam_cooldown_until - now)
+    if wait_sec > 0:
+      try:
+        await asyncio.wait_for(poll_wakeup.wait(), timeout=min(wait_sec, 60))
+      except asyncio.TimeoutError:
+        pass
+      continue
+
+    due = []
+    while due_heap and due_heap[0][0] <= now:
+      due_at, item_id = heapq.heappop(due_heap)
+      if item_due.get(item_id) != due_at:
+        continue
 
-    for it in local_items:
-      if not it.get("enabled"):
+      it = items_by_id.get(item_id)
+      if not it:
+        item_due.pop(item_id, None)
         continue
 
-      user = token_to_user.get(it.get("user_token"))
-      if not user:
+      user = users_by_token.get(it["user_token"])
+      interval = user_interval_sec(user) if user else 600
+      schedule_item(it, now + interval)
+
+      if not it.get("enabled") or not user:
         continue
 
       chat_id = user.get("tg_chat_id")
       if not chat_id:
         continue
 
+      # Из настроек нужны только валюта и её подпись - без копии словаря
       settings = user.get("settings") or {}
+      due.append((
+        it,
+        chat_id,
+        settings.get("currency_code", 5),
+        settings.get("currency_label", "RUB")
+      ))
+
+    # Цены запрашиваем параллельно, семафор ограничивает нагрузку на Steam
+    sem = asyncio.Semaphore(steam_concurrency)
+    skipped = object()
+
+    async def fetch_one(it, currency_code):
+      async with sem:
+        # Steam начал отвечать 429 - оставшиеся запросы цикла не отправляем
+        if steam_cooldown_until > now_sec():
+          return skipped
+        return await fetch_price(it["appid"], it["hash_name"], currency_code)
+
+    results = await asyncio.gather(
+      *[fetch_one(it, currency_code) for it, _, currency_code, _ in due],
+      return_exceptions=True
+    )
+    evict_price_cache()
 
-      interval_min = settings.get("interval_min", 10)
-      try:
-        interval_min = int(interval_min)
-      except Exception:
-        interval_min = 10
-
-      if interval_min < 1:
-        interval_min = 1
+    # last_checked_at сохраняем, чтобы после перезапуска предметы не
+    # опрашивались все разом; частоту записи items.json ограничивает
+    # items_flush_gap. Если в цикле ничего не проверили - диск не трогаем
+    changed = False
 
-      if now - it.get("last_checked_at", 0) < interval_min * 60:
+    for (it, chat_id, _, cur), price_now in zip(due, results):
+      if price_now is skipped:
+        schedule_item(it, steam_cooldown_until)
         continue
 
-      price_now = await fetch_price(
-        it["appid"],
-        it["hash_name"],
-        settings.get("currency_code", 5)
-      )
+      if isinstance(price_now, Exception):
+        logger.error("price fetch task error: %r", price_now)
+        price_now = None
 
-      it["last_checked_at"] = now
-      it["last_price"] = price_now
+      text = None
 
-      if price_now is None:
+      try:
+        async with user_lock(it["user_token"]):
+          it["last_checked_at"] = now
+          changed = True
+
+          # /api/state показывает last_checked_at - его сбрасываем всегда;
+          # текст /list зависит только от цены, его - лишь при её изменении
+          if price_now != it.get("last_price"):
+            it["last_price"] = price_now
+            invalidate_user_views(it["user_token"])
+          else:
+            state_snapshot.pop(it["user_token"], None)
+
+          if price_now is None:
+            continue
+
+          cooldown = 3600
+          if now - it.get("last_notified_at", 0) < cooldown:
+            continue
+
+          direction = it.get("direction")
+          target = it.get("target_price")
+
+          if direction == "buy":
+            if price_now <= target:
+              it["last_notified_at"] = now
+              text = (
+                f"[{it['hash_name']}] is now selling for "
+                f"[{price_now} {cur}] — hurry up and buy!"
+              )
+
+          if direction == "sell":
+            if price_now >= target:
+              it["last_notified_at"] = now
+              text = (
+                f"[{it['hash_name']}] just went up to "
+                f"[{price_now} {cur}] — hurry up and sell!"
+              )
+      except Exception:
+        # Одна битая запись (например, target_price: null) не должна
+        # ронять polling_loop - иначе уведомления встанут у всех
+        logger.exception("polling: cannot apply price to %s", it.get("id"))
         continue
 
-      cooldown = 3600
-      if now - it.get("last_notified_at", 0) < cooldown:
-        continue
+      if text:
+        queue_message(chat_id, text)
 
-      direction = it.get("direction")
-      target = it.get("target_price")
-      cur = settings.get("currency_label", "RUB")
+    if changed:
+      mark_items_dirty()
+
+
+async def flusher():
+  retry_sec = flush_interval
+  while True:
+    await flush_needed.wait()
+    await asyncio.sleep(flush_interval)
+    flush_needed.clear()
+    try:
+      await flush_dirty()
+      retry_sec = flush_interval
+    except Exception as e:
+      # Запись не проходит - повторяем с нарастающей паузой (до минуты),
+      # а не каждую секунду
+      logger.error("flush error, retry in %s sec: %s", retry_sec, e)
+      await asyncio.sleep(retry_sec)
+      retry_sec = min(retry_sec * 2, 60)
+      flush_needed.set()
+      continue
+
+    # items отложены до конца items_flush_gap - заходим ещё раз
+    if items_dirty:
+      flush_needed.set()
 
-      if direction == "buy":
-        if price_now <= target:
-          it["last_notified_at"] = now
-          text = (
-            f"[{it['hash_name']}] is now selling for "
-            f"[{price_now} {cur}] — hurry up and buy!"
-          )
-          try:
-            await tg_bot.send_message(chat_id, text)
-          except Exception as e:
-            print("tg send error:", e)
-
-      if direction == "sell":
-        if price_now >= target:
-          it["last_notified_at"] = now
-          text = (
-            f"[{it['hash_name']}] just went up to "
-            f"[{price_now} {cur}] — hurry up and sell!"
-          )
-          try:
-            await tg_bot.send_message(chat_id, text)
-          except Exception as e:
-            print("tg send error:", e)
-
-    async with lock:
-      id_to_item = {it["id"]: it for it in local_items}
-
-      for i in range(len(items)):
-        old_id = items[i]["id"]
-        if old_id in id_to_item:
-          items[i] = id_to_item[old_id]
-
-      save_json(items_path, items)
 
+async def flush_on_cleanup(app):
+  await flush_dirty(force=True)
 
 
 async def main():
   app = web.Application(middlewares=[cors_middleware])
+  app.on_cleanup.append(close_steam_session)
+  app.on_cleanup.append(flush_on_cleanup)
 
   app.router.add_get("/healthz", healthz)
   app.router.add_route("OPTIONS", "/{tail:.*}", healthz)
@@ -903,7 +1414,10 @@ async def main():
   app.router.add_post("/api/untrack", api_untrack)
   app.router.add_get("/api/backup", api_backup)
 
-  runner = web.AppRunner(app)
+  # Access-лог и "Update handled" от aiogram - по строке на каждый запрос
+  # расширения и апдейт Telegram; раньше они не выводились, так и оставляем
+  logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+  runner = web.AppRunner(app, access_log=None)
   await runner.setup()
 
   port = int(os.getenv("PORT", "10000"))
@@ -911,8 +1425,18 @@ async def main():
   await site.start()
 
   asyncio.create_task(polling_loop())
-  await dp.start_polling(tg_bot)
+  asyncio.create_task(flusher())
+  for queue in tg_queues:
+    asyncio.create_task(tg_worker(queue))
+
+  try:
+    await dp.start_polling(tg_bot)
+  finally:
+    await runner.cleanup()
 
 
 if __name__ == "__main__":
-  asyncio.run(main())
+  if uvloop is not None:
+    uvloop.run(main())
+  else:
+    asyncio.run(main())